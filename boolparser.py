@@ -10,31 +10,140 @@ Usage:
 from boolparser import *
 p = BooleanParser('<expression text>')
 p.evaluate(variable_dict) # variable_dict is a dictionary providing values for variables that appear in <expression text>
+
+After parsing, the tree is normalized: comparisons between literals are
+folded, and/or chains are flattened and redundant operands dropped.
+p.isAlwaysTrue() and p.isAlwaysFalse() tell whether the result is statically
+known.
+
+The parse tree is compiled into a single Python function the first time
+p.evaluate(...) is called, later calls are a direct call to it.
+
+Use parse('<expression text>') to share parsed expressions through the
+process-wide expression_cache.
+
+p.flatten() returns the expression as a compact Program for a stack machine,
+which can be serialized to bytes and loaded back without reparsing.
+
+Expressions combining variables can be added to a shared BDD, where
+common sub-formulas are represented once, and evaluated together through
+BDD.evaluator(variable_dict).
+
+If numpy is available, p.evaluateBatch(matrix, columns) evaluates the
+expression over a whole boolean matrix, one row per variable assignment.
 """
 
+import struct
+import sys
+import threading
+
+from array import array
+from collections import OrderedDict
+
 
 class TokenType:
-    NUM, STR, VAR, GT, GTE, LT, LTE, EQ, NEQ, LP, RP, AND, OR, STRWITH = range(14)
+    NUM, STR, VAR, GT, GTE, LT, LTE, EQ, NEQ, LP, RP, AND, OR, STRWITH, BOOL = range(15)
+
+    # BOOL is never produced by the tokenizer, only by constant folding
+    LITERALS = (NUM, STR, BOOL)
+
+
+class Opcode:
+    PUSH, LOAD, LOAD_NOT, JUMP_IF_FALSE_OR_POP, JUMP_IF_TRUE_OR_POP, GT, GTE, LT, LTE, EQ, NEQ, STRWITH = range(12)
+
+    COMPARISONS = {
+        TokenType.GT: GT,
+        TokenType.GTE: GTE,
+        TokenType.LT: LT,
+        TokenType.LTE: LTE,
+        TokenType.EQ: EQ,
+        TokenType.NEQ: NEQ,
+        TokenType.STRWITH: STRWITH,
+    }
+
+    OPERATIONS = {
+        GT: lambda left, right: left > right,
+        GTE: lambda left, right: left >= right,
+        LT: lambda left, right: left < right,
+        LTE: lambda left, right: left <= right,
+        EQ: lambda left, right: left == right,
+        NEQ: lambda left, right: left != right,
+        STRWITH: lambda left, right: left.startswith(right),
+    }
 
 
 class TreeNode:
-    tokenType = None
-    value = None
-    left = None
-    right = None
+    __slots__ = ("tokenType", "value", "left", "right", "children")
 
     def __init__(self, tokenType):
         self.tokenType = tokenType
+        self.value = None
+        self.left = None
+        self.right = None
+        # Operands of normalized and/or nodes
+        self.children = None
 
 
-class Tokenizer:
-    expression = None
-    tokens = None
-    tokenTypes = None
+WHITESPACE = frozenset(" \t\n\r\f\v")
+DIGITS = frozenset("0123456789")
+NUMBER_START = DIGITS | frozenset("+-.")
+IDENTIFIER_CHARACTERS = frozenset("-!_"
+                                  "abcdefghijklmnopqrstuvwxyz"
+                                  "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                                  "0123456789")
+OPERATORS = {
+    "==": TokenType.EQ,
+    "!=": TokenType.NEQ,
+    "<=": TokenType.LTE,
+    ">=": TokenType.GTE,
+    ".*": TokenType.STRWITH,
+    "<": TokenType.LT,
+    ">": TokenType.GT,
+    "(": TokenType.LP,
+    ")": TokenType.RP,
+}
+WORD_DELIMITERS = WHITESPACE | frozenset("()<>=\"'")
+
+
+def isNumber(word):
+    """Tell whether word is a decimal number, optionally signed, with an
+    optional fractional part and exponent"""
+    length = len(word)
     i = 0
+    if i < length and (word[i] == "-" or word[i] == "+"):
+        i += 1
+    digits = 0
+    while i < length and word[i] in DIGITS:
+        i += 1
+        digits += 1
+    if i < length and word[i] == ".":
+        i += 1
+        while i < length and word[i] in DIGITS:
+            i += 1
+            digits += 1
+    if digits == 0:
+        return False
+    if i < length and (word[i] == "e" or word[i] == "E"):
+        i += 1
+        if i < length and (word[i] == "-" or word[i] == "+"):
+            i += 1
+        if i == length or word[i] not in DIGITS:
+            return False
+        while i < length and word[i] in DIGITS:
+            i += 1
+    return i == length
+
+
+class Tokenizer:
+    """Splits an expression into tokens and keeps the cursor used while
+    parsing them. A Tokenizer is only meant to be used for a single parse."""
 
     def __init__(self, exp):
         self.expression = exp
+        self.tokens = ()
+        self.tokenTypes = ()
+        self.offsets = ()
+        self.i = 0
 
     def next(self):
         self.i += 1
@@ -46,6 +155,13 @@ class Tokenizer:
     def hasNext(self):
         return self.i < len(self.tokens)
 
+    def nextForError(self):
+        """Consume the next token, if any, and describe it for an error
+        message"""
+        if self.hasNext():
+            return repr(self.next())
+        return "nothing"
+
     def nextTokenType(self):
         return self.tokenTypes[self.i]
 
@@ -62,181 +178,907 @@ class Tokenizer:
         )
 
     def tokenize(self):
-        import re
-
-        reg = re.compile(r"(\band\b|\bor\b|!=|==|<=|>=|<|>|\(|\)|\.\*)")
-        self.tokens = reg.split(self.expression)
-        self.tokens = [t.strip() for t in self.tokens if t.strip() != ""]
-
-        self.tokenTypes = []
-        for t in self.tokens:
-            if t == "and":
-                self.tokenTypes.append(TokenType.AND)
-            elif t == "or":
-                self.tokenTypes.append(TokenType.OR)
-            elif t == "(":
-                self.tokenTypes.append(TokenType.LP)
-            elif t == ")":
-                self.tokenTypes.append(TokenType.RP)
-            elif t == "<":
-                self.tokenTypes.append(TokenType.LT)
-            elif t == "<=":
-                self.tokenTypes.append(TokenType.LTE)
-            elif t == ">":
-                self.tokenTypes.append(TokenType.GT)
-            elif t == ">=":
-                self.tokenTypes.append(TokenType.GTE)
-            elif t == "==":
-                self.tokenTypes.append(TokenType.EQ)
-            elif t == "!=":
-                self.tokenTypes.append(TokenType.NEQ)
-            elif t == ".*":
-                self.tokenTypes.append(TokenType.STRWITH)
+        """Split the expression into tokens in a single left to right scan,
+        recording the type and the offset in the expression of each token"""
+        expression = self.expression
+        length = len(expression)
+        tokens = []
+        tokenTypes = []
+        offsets = []
+
+        i = 0
+        while i < length:
+            c = expression[i]
+            if c in WHITESPACE:
+                i += 1
+                continue
+
+            start = i
+            pair = expression[i:i + 2]
+            if pair in OPERATORS:
+                tokenType = OPERATORS[pair]
+                i += 2
+            elif c in OPERATORS:
+                tokenType = OPERATORS[c]
+                i += 1
+            elif c == '"' or c == "'":
+                end = expression.find(c, i + 1)
+                if end == -1:
+                    # Unterminated string
+                    tokenType = None
+                    i = length
+                else:
+                    tokenType = TokenType.STR
+                    i = end + 1
             else:
-                # number of string or variable
-                if t[0] == t[-1] == '"' or t[0] == t[-1] == "'":
-                    self.tokenTypes.append(TokenType.STR)
+                # A word, up to the next whitespace or operator
+                while i < length:
+                    c = expression[i]
+                    if c in WORD_DELIMITERS:
+                        break
+                    if (c == "!" or c == ".") and expression[i:i + 2] in OPERATORS:
+                        break
+                    i += 1
+                if i == start:
+                    # A character that can't start any token
+                    i += 1
+                word = expression[start:i]
+                if word == "and":
+                    tokenType = TokenType.AND
+                elif word == "or":
+                    tokenType = TokenType.OR
+                elif word[0] in NUMBER_START and isNumber(word):
+                    tokenType = TokenType.NUM
+                elif IDENTIFIER_CHARACTERS.issuperset(word):
+                    tokenType = TokenType.VAR
                 else:
-                    try:
-                        number = float(t)
-                        self.tokenTypes.append(TokenType.NUM)
-                    except:
-                        # Kinda broken
-                        if re.search("^[-!a-zA-Z0-9_]+$", t):
-                            self.tokenTypes.append(TokenType.VAR)
-                        else:
-                            self.tokenTypes.append(None)
+                    tokenType = None
+
+            tokens.append(expression[start:i])
+            tokenTypes.append(tokenType)
+            offsets.append(start)
+
+        self.tokens = tuple(tokens)
+        self.tokenTypes = tuple(tokenTypes)
+        self.offsets = tuple(offsets)
+        self.i = 0
 
 
 class BooleanParser:
-    tokenizer = None
-    root = None
+    """A parsed expression. Parsing happens entirely in the constructor on a
+    private Tokenizer, after which the object is immutable, apart from the
+    functions compiled on first use: it can be shared between threads, and
+    pickling it sends the expression text, so it can also be handed to other
+    processes."""
+
+    __slots__ = ("expression", "root", "function", "maskFunctions")
+
+    # Guards maskFunctions of all the parsers, compiling masks is rare
+    maskLock = threading.Lock()
 
     def __init__(self, exp):
-        self.tokenizer = Tokenizer(exp)
-        self.tokenizer.tokenize()
-        self.parse()
-
-    def parse(self):
-        self.root = self.parseExpression()
-
-    def parseExpression(self):
-        andTerm1 = self.parseAndTerm()
-        while (
-                self.tokenizer.hasNext() and self.tokenizer.nextTokenType() == TokenType.OR
-        ):
-            self.tokenizer.next()
-            andTermX = self.parseAndTerm()
-            andTerm = TreeNode(TokenType.OR)
-            andTerm.left = andTerm1
-            andTerm.right = andTermX
-            andTerm1 = andTerm
-        return andTerm1
-
-    def parseAndTerm(self):
-        condition1 = self.parseCondition()
-        while (
-                self.tokenizer.hasNext() and self.tokenizer.nextTokenType() == TokenType.AND
-        ):
-            self.tokenizer.next()
-            conditionX = self.parseCondition()
-            condition = TreeNode(TokenType.AND)
-            condition.left = condition1
-            condition.right = conditionX
-            condition1 = condition
-        return condition1
-
-    def parseCondition(self):
-        if self.tokenizer.hasNext() and self.tokenizer.nextTokenType() == TokenType.LP:
-            self.tokenizer.next()
-            expression = self.parseExpression()
-            if (
-                    self.tokenizer.hasNext()
-                    and self.tokenizer.nextTokenType() == TokenType.RP
-            ):
-                self.tokenizer.next()
-                return expression
-            else:
-                raise Exception("Closing ) expected, but got " + self.tokenizer.next())
-
-        terminal1 = self.parseTerminal()
-        if self.tokenizer.hasNext():
-            if self.tokenizer.nextTokenTypeIsOperator():
-                condition = TreeNode(self.tokenizer.nextTokenType())
-                self.tokenizer.next()
-                terminal2 = self.parseTerminal()
-                condition.left = terminal1
-                condition.right = terminal2
-                return condition
-            else:
-                return terminal1
-                raise Exception("Operator expected, but got " + self.tokenizer.next())
+        self.expression = exp
+        # Compiled on first use, see evaluate and compileMask
+        self.function = None
+        self.maskFunctions = None
+        # Must be the last attribute to be set, see __setattr__
+        self.root = self.normalize(self.parse(exp))
+
+    def __setattr__(self, name, value):
+        if hasattr(self, "root"):
+            raise AttributeError("BooleanParser objects are immutable")
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return (BooleanParser, (self.expression,))
+
+    def parse(self, exp):
+        """Parse exp and return the root of its parse tree"""
+        tokenizer = Tokenizer(exp)
+        tokenizer.tokenize()
+        root = self.parseExpression(tokenizer)
+        if tokenizer.hasNext():
+            raise Exception("and, or or end of the expression expected, but got "
+                            + tokenizer.nextForError())
+        return root
+
+    def parseExpression(self, tokenizer):
+        """Parse an expression without recursing on nested parentheses: the
+        partial or/and chains of the enclosing parentheses are kept on an
+        explicit stack"""
+        enclosing = []
+        orTerm = None
+        andTerm = None
+        while True:
+            # Open parentheses until the next condition
+            while tokenizer.hasNext() and tokenizer.nextTokenType() == TokenType.LP:
+                tokenizer.next()
+                enclosing.append((orTerm, andTerm))
+                orTerm = None
+                andTerm = None
+
+            condition = self.parseCondition(tokenizer)
+
+            # Add the condition to the current chains, closing parentheses as
+            # long as the next token is )
+            while True:
+                if andTerm is None:
+                    andTerm = condition
+                else:
+                    node = TreeNode(TokenType.AND)
+                    node.left = andTerm
+                    node.right = condition
+                    andTerm = node
+
+                if tokenizer.hasNext() and tokenizer.nextTokenType() == TokenType.AND:
+                    break
+
+                if orTerm is None:
+                    orTerm = andTerm
+                else:
+                    node = TreeNode(TokenType.OR)
+                    node.left = orTerm
+                    node.right = andTerm
+                    orTerm = node
+                andTerm = None
+
+                if tokenizer.hasNext() and tokenizer.nextTokenType() == TokenType.OR:
+                    break
+
+                if not enclosing:
+                    return orTerm
+
+                if tokenizer.hasNext() and tokenizer.nextTokenType() == TokenType.RP:
+                    tokenizer.next()
+                    condition = orTerm
+                    orTerm, andTerm = enclosing.pop()
+                else:
+                    raise Exception("Closing ) expected, but got " + tokenizer.nextForError())
+
+            # Skip the and/or
+            tokenizer.next()
+
+    def parseCondition(self, tokenizer):
+        terminal1 = self.parseTerminal(tokenizer)
+        if tokenizer.hasNext() and tokenizer.nextTokenTypeIsOperator():
+            condition = TreeNode(tokenizer.nextTokenType())
+            tokenizer.next()
+            terminal2 = self.parseTerminal(tokenizer)
+            condition.left = terminal1
+            condition.right = terminal2
+            return condition
         else:
             return terminal1
-            raise Exception("Operator expected, but got nothing")
 
-    def parseTerminal(self):
-        if self.tokenizer.hasNext():
-            tokenType = self.tokenizer.nextTokenType()
+    def parseTerminal(self, tokenizer):
+        if tokenizer.hasNext():
+            tokenType = tokenizer.nextTokenType()
             if tokenType == TokenType.NUM:
                 n = TreeNode(tokenType)
-                n.value = float(self.tokenizer.next())
+                n.value = float(tokenizer.next())
                 return n
             elif tokenType == TokenType.VAR:
                 n = TreeNode(tokenType)
-                n.value = self.tokenizer.next()
+                n.value = tokenizer.next()
                 return n
             elif tokenType == TokenType.STR:
                 n = TreeNode(tokenType)
-                n.value = self.tokenizer.next()[1:-1]
+                n.value = tokenizer.next()[1:-1]
                 return n
             else:
                 raise Exception(
-                    "NUM, STR, or VAR expected, but got " + self.tokenizer.next()
+                    "NUM, STR, or VAR expected, but got " + tokenizer.nextForError()
                 )
 
         else:
             raise Exception(
-                "NUM, STR, or VAR expected, but got " + self.tokenizer.next()
+                "NUM, STR, or VAR expected, but got " + tokenizer.nextForError()
             )
 
-    def evaluate(self, variable_dict):
-        return self.evaluateRecursive(self.root, variable_dict)
+    def normalize(self, root):
+        """Fold comparisons between literals, merge nested and/or chains into
+        a single node with children and drop constant, duplicated,
+        contradictory and absorbed operands. The truth value of the
+        expression is preserved. Returns the root of the normalized tree."""
+        # Identifiers of structurally equal normalized nodes
+        keys = {}
+        nodeKeys = {}
+
+        def intern(treeNode, key):
+            nodeKeys[treeNode] = keys.setdefault(key, len(keys))
+            return treeNode
+
+        def constant(value):
+            treeNode = TreeNode(TokenType.BOOL)
+            treeNode.value = value
+            return intern(treeNode, (TokenType.BOOL, value))
+
+        results = {}
+        pending = [(root, False)]
+        while pending:
+            treeNode, ready = pending.pop()
+            tokenType = treeNode.tokenType
+            if tokenType in TokenType.LITERALS or tokenType == TokenType.VAR:
+                results[treeNode] = intern(treeNode, (tokenType, treeNode.value))
+                continue
+
+            if tokenType == TokenType.AND or tokenType == TokenType.OR:
+                operands = self.chainOperands(treeNode)
+            else:
+                operands = [treeNode.left, treeNode.right]
+
+            if not ready:
+                pending.append((treeNode, True))
+                pending.extend((operand, False) for operand in operands)
+                continue
+
+            operands = [results.pop(operand) for operand in operands]
+
+            if tokenType != TokenType.AND and tokenType != TokenType.OR:
+                left, right = operands
+                result = TreeNode(tokenType)
+                result.left = left
+                result.right = right
+                intern(result, (tokenType, nodeKeys[left], nodeKeys[right]))
+                if (left.tokenType in TokenType.LITERALS
+                    and right.tokenType in TokenType.LITERALS):
+                    operation = Opcode.OPERATIONS[Opcode.COMPARISONS[tokenType]]
+                    try:
+                        result = constant(bool(operation(left.value, right.value)))
+                    except Exception:
+                        # Leave it to fail at evaluation time
+                        pass
+                results[treeNode] = result
+                continue
+
+            # In an and, true operands are neutral and a false one decides the
+            # result, the other way around in an or
+            isAnd = tokenType == TokenType.AND
+            children = []
+            seen = set()
+            decided = False
+            for operand in operands:
+                if operand.tokenType == tokenType:
+                    flattened = operand.children
+                else:
+                    flattened = [operand]
+                for child in flattened:
+                    if child.tokenType in TokenType.LITERALS:
+                        if bool(child.value) != isAnd:
+                            decided = True
+                        continue
+                    if nodeKeys[child] in seen:
+                        continue
+                    if child.tokenType == TokenType.VAR:
+                        variable = child.value
+                        complement = variable[1:] if variable.startswith("!") else "!" + variable
+                        if keys.get((TokenType.VAR, complement)) in seen:
+                            decided = True
+                    seen.add(nodeKeys[child])
+                    children.append(child)
+
+            if decided:
+                results[treeNode] = constant(not isAnd)
+                continue
+
+            # Absorption: a or (a and b) is a, a and (a or b) is a
+            children = [child
+                        for child
+                        in children
+                        if child.children is None
+                        or not any(nodeKeys[grandchild] in seen
+                                   for grandchild
+                                   in child.children)]
+
+            if not children:
+                results[treeNode] = constant(isAnd)
+            elif len(children) == 1:
+                results[treeNode] = children[0]
+            else:
+                result = TreeNode(tokenType)
+                result.children = children
+                results[treeNode] = intern(result,
+                                           (tokenType,
+                                            tuple(nodeKeys[child] for child in children)))
 
-    def evaluateRecursive(self, treeNode, variable_dict):
-        if treeNode.tokenType == TokenType.NUM or treeNode.tokenType == TokenType.STR:
-            return treeNode.value
-        if treeNode.tokenType == TokenType.VAR:
+        return results[root]
+
+    def isAlwaysTrue(self):
+        return self.root.tokenType in TokenType.LITERALS and bool(self.root.value)
+
+    def isAlwaysFalse(self):
+        return self.root.tokenType in TokenType.LITERALS and not self.root.value
+
+    def compile(self):
+        """Turn the parse tree into a Python function taking the variable
+        dictionary as its only argument"""
+        constants = {}
+        try:
+            source = self.compileRecursive(self.root, constants)
+            return eval("lambda variables: " + source, constants)
+        except (SyntaxError, RecursionError, MemoryError):
+            # Too deeply nested for the Python compiler, use the flat program
+            return self.flatten().evaluate
+
+    def compileMask(self, bits):
+        """Compile the expression into a function taking an integer mask of
+        the variables that are true, bits maps each variable name to its bit.
+
+        Returns None if the expression is not a pure combination of
+        variables, that is if it compares a variable against something.
+        Results are cached on the bits of the variables in use."""
+        key = tuple((variable, bits.get(variable))
+                    for variable
+                    in self.variables())
+        with self.maskLock:
+            if self.maskFunctions is not None and key in self.maskFunctions:
+                return self.maskFunctions[key]
+
+        function = None
+        try:
+            source = self.compileMaskRecursive(self.root, bits)
+            if source is not None:
+                function = eval("lambda mask: " + source, {})
+        except (SyntaxError, RecursionError, MemoryError):
+            # Too deeply nested, leave it to the general evaluator
+            pass
+
+        with self.maskLock:
+            if self.maskFunctions is None:
+                object.__setattr__(self, "maskFunctions", {})
+            return self.maskFunctions.setdefault(key, function)
+
+    def variables(self):
+        """Return the sorted names of the variables used in the expression"""
+        result = set()
+        pending = [self.root]
+        while pending:
+            treeNode = pending.pop()
+            if treeNode.tokenType == TokenType.VAR:
+                result.add(treeNode.value.lstrip("!"))
+            elif treeNode.children is not None:
+                pending.extend(treeNode.children)
+            elif treeNode.left is not None:
+                pending.append(treeNode.left)
+                pending.append(treeNode.right)
+        return sorted(result)
+
+    def requiredVariables(self):
+        """Return the sorted names of the variables that must be true for the
+        expression to be true"""
+        if self.root.tokenType == TokenType.AND:
+            operands = self.root.children
+        else:
+            operands = [self.root]
+        return sorted(operand.value
+                      for operand
+                      in operands
+                      if operand.tokenType == TokenType.VAR
+                      and not operand.value.startswith("!"))
+
+    def compileMaskRecursive(self, treeNode, bits):
+        tokenType = treeNode.tokenType
+        if tokenType in TokenType.LITERALS:
+            return repr(bool(treeNode.value))
+        if tokenType == TokenType.VAR:
             variable = treeNode.value
-            negate = False
-            if variable.startswith("!"):
-                negate = True
+            negate = variable.startswith("!")
+            if negate:
                 variable = variable[1:]
-            value = variable_dict.get(variable, False)
-            return not value if negate else value
-
-        left = self.evaluateRecursive(treeNode.left, variable_dict)
-        right = self.evaluateRecursive(treeNode.right, variable_dict)
-        if treeNode.tokenType == TokenType.GT:
-            return left > right
-        elif treeNode.tokenType == TokenType.GTE:
-            return left >= right
-        elif treeNode.tokenType == TokenType.LT:
-            return left < right
-        elif treeNode.tokenType == TokenType.LTE:
-            return left <= right
-        elif treeNode.tokenType == TokenType.EQ:
-            return left == right
-        elif treeNode.tokenType == TokenType.NEQ:
-            return left != right
-        elif treeNode.tokenType == TokenType.AND:
-            return left and right
-        elif treeNode.tokenType == TokenType.OR:
-            return left or right
-        elif treeNode.tokenType == TokenType.STRWITH:
-            return left.startswith(right)
-        else:
-            raise Exception("Unexpected type " + str(treeNode.tokenType))
+            if variable not in bits:
+                return repr(negate)
+            return f"(mask & {bits[variable]}) {'==' if negate else '!='} 0"
+
+        if tokenType == TokenType.AND or tokenType == TokenType.OR:
+            # Merge all the plain variables of the chain into two masks
+            is_and = tokenType == TokenType.AND
+            positive = 0
+            negative = 0
+            terms = []
+            for operand in self.chainOperands(treeNode):
+                if operand.tokenType != TokenType.VAR:
+                    term = self.compileMaskRecursive(operand, bits)
+                    if term is None:
+                        return None
+                    terms.append(f"({term})")
+                    continue
+
+                variable = operand.value
+                negate = variable.startswith("!")
+                if negate:
+                    variable = variable[1:]
+                if variable not in bits:
+                    if negate != is_and:
+                        # Always false in an and, always true in an or
+                        return repr(not is_and)
+                elif negate:
+                    negative |= bits[variable]
+                else:
+                    positive |= bits[variable]
+
+            if is_and:
+                if positive:
+                    terms.insert(0, f"(mask & {positive}) == {positive}")
+                if negative:
+                    terms.insert(0, f"(mask & {negative}) == 0")
+                return " and ".join(terms) if terms else "True"
+            else:
+                if positive:
+                    terms.insert(0, f"(mask & {positive}) != 0")
+                if negative:
+                    terms.insert(0, f"(mask & {negative}) != {negative}")
+                return " or ".join(terms) if terms else "False"
+
+        # Comparisons are pure only if both sides are literals
+        if (treeNode.left.tokenType not in TokenType.LITERALS
+            or treeNode.right.tokenType not in TokenType.LITERALS):
+            return None
+        operation = Opcode.OPERATIONS[Opcode.COMPARISONS[tokenType]]
+        return repr(bool(operation(treeNode.left.value, treeNode.right.value)))
+
+    def chainOperands(self, treeNode):
+        """Collect, left to right, the operands of a chain of AND (or OR)
+        nodes of the same type as treeNode"""
+        if treeNode.children is not None:
+            return treeNode.children
+
+        operands = []
+        pending = [treeNode]
+        while pending:
+            node = pending.pop()
+            if node.tokenType == treeNode.tokenType:
+                pending.append(node.right)
+                pending.append(node.left)
+            else:
+                operands.append(node)
+        return operands
+
+    def compileRecursive(self, treeNode, constants):
+        tokenType = treeNode.tokenType
+        if tokenType in TokenType.LITERALS:
+            name = f"c{len(constants)}"
+            constants[name] = treeNode.value
+            return name
+        if tokenType == TokenType.VAR:
+            variable = treeNode.value
+            if variable.startswith("!"):
+                return f"(not variables.get({variable[1:]!r}, False))"
+            return f"variables.get({variable!r}, False)"
+
+        if tokenType == TokenType.AND or tokenType == TokenType.OR:
+            operator = " and " if tokenType == TokenType.AND else " or "
+            return "(" + operator.join(self.compileRecursive(operand, constants)
+                                       for operand
+                                       in self.chainOperands(treeNode)) + ")"
+
+        left = self.compileRecursive(treeNode.left, constants)
+        right = self.compileRecursive(treeNode.right, constants)
+        if tokenType == TokenType.STRWITH:
+            return f"{left}.startswith({right})"
+
+        operators = {
+            TokenType.GT: ">",
+            TokenType.GTE: ">=",
+            TokenType.LT: "<",
+            TokenType.LTE: "<=",
+            TokenType.EQ: "==",
+            TokenType.NEQ: "!=",
+        }
+        if tokenType not in operators:
+            raise Exception("Unexpected type " + str(tokenType))
+        return f"({left} {operators[tokenType]} {right})"
+
+    def evaluate(self, variable_dict):
+        function = self.function
+        if function is None:
+            # Compiling it twice in a race is harmless
+            function = self.compile()
+            object.__setattr__(self, "function", function)
+        return function(variable_dict)
+
+
+    def evaluateBatch(self, matrix, columns):
+        """Evaluate the expression over a boolean numpy matrix where each row
+        is a variable assignment, columns maps variable names to columns.
+        Returns a boolean vector with one entry per row.
+
+        Each node of the tree is evaluated once for the whole batch."""
+        # numpy takes a while to import, only load it when needed
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("evaluateBatch requires numpy")
+
+        rows = matrix.shape[0]
+
+        def truth(value):
+            if isinstance(value, numpy.ndarray):
+                return value.astype(bool, copy=False)
+            return bool(value)
+
+        results = {}
+        pending = [(self.root, False)]
+        while pending:
+            treeNode, ready = pending.pop()
+            tokenType = treeNode.tokenType
+            if tokenType in TokenType.LITERALS:
+                results[treeNode] = treeNode.value
+            elif tokenType == TokenType.VAR:
+                variable = treeNode.value
+                negate = variable.startswith("!")
+                if negate:
+                    variable = variable[1:]
+                if variable in columns:
+                    value = matrix[:, columns[variable]]
+                else:
+                    value = numpy.zeros(rows, dtype=bool)
+                results[treeNode] = ~value if negate else value
+            elif tokenType == TokenType.AND or tokenType == TokenType.OR:
+                operands = self.chainOperands(treeNode)
+                if not ready:
+                    pending.append((treeNode, True))
+                    pending.extend((operand, False) for operand in operands)
+                    continue
+                combine = numpy.logical_and if tokenType == TokenType.AND else numpy.logical_or
+                value = truth(results.pop(operands[0]))
+                for operand in operands[1:]:
+                    value = combine(value, truth(results.pop(operand)))
+                results[treeNode] = value
+            elif tokenType in Opcode.COMPARISONS:
+                if not ready:
+                    pending.append((treeNode, True))
+                    pending.append((treeNode.right, False))
+                    pending.append((treeNode.left, False))
+                    continue
+                left = results.pop(treeNode.left)
+                right = results.pop(treeNode.right)
+                if (tokenType == TokenType.STRWITH
+                    and isinstance(left, numpy.ndarray)):
+                    raise Exception("Cannot use .* on a variable")
+                operation = Opcode.OPERATIONS[Opcode.COMPARISONS[tokenType]]
+                results[treeNode] = operation(left, right)
+            else:
+                raise Exception("Unexpected type " + str(tokenType))
+
+        return numpy.broadcast_to(truth(results[self.root]), (rows,))
+
+    def flatten(self):
+        """Turn the parse tree into a Program, without recursing on the tree"""
+        code = []
+        constants = {}
+
+        def constant(value):
+            return constants.setdefault((type(value), value), len(constants))
+
+        pending = [self.root]
+        while pending:
+            item = pending.pop()
+            if type(item) is list:
+                # Jump sites of an and/or chain, target the current position
+                for site in item:
+                    code[site + 1] = len(code)
+            elif type(item) is tuple:
+                opcode, sites = item
+                if sites is not None:
+                    sites.append(len(code))
+                code += (opcode, 0)
+            elif item.tokenType in TokenType.LITERALS:
+                code += (Opcode.PUSH, constant(item.value))
+            elif item.tokenType == TokenType.VAR:
+                if item.value.startswith("!"):
+                    code += (Opcode.LOAD_NOT, constant(item.value[1:]))
+                else:
+                    code += (Opcode.LOAD, constant(item.value))
+            elif item.tokenType == TokenType.AND or item.tokenType == TokenType.OR:
+                if item.tokenType == TokenType.AND:
+                    jump = Opcode.JUMP_IF_FALSE_OR_POP
+                else:
+                    jump = Opcode.JUMP_IF_TRUE_OR_POP
+                operands = self.chainOperands(item)
+                sites = []
+                pending.append(sites)
+                pending.append(operands[-1])
+                for operand in reversed(operands[:-1]):
+                    pending.append((jump, sites))
+                    pending.append(operand)
+            elif item.tokenType in Opcode.COMPARISONS:
+                pending.append((Opcode.COMPARISONS[item.tokenType], None))
+                pending.append(item.right)
+                pending.append(item.left)
+            else:
+                raise Exception("Unexpected type " + str(item.tokenType))
+
+        typecode = "H" if max(len(code), len(constants)) <= 0xFFFF else "I"
+        return Program(array(typecode, code),
+                       tuple(value for _, value in constants))
+
+
+class Program:
+    """Postfix form of an expression for a stack machine. code is an array of
+    (opcode, operand) pairs, the operand being an index in constants for
+    PUSH, LOAD and LOAD_NOT, the position to jump to for jumps and unused
+    otherwise. A Program can be serialized with toBytes and loaded back with
+    fromBytes, without reparsing the expression."""
+
+    __slots__ = ("code", "constants")
+
+    MAGIC = b"BPP1"
+
+    def __init__(self, code, constants):
+        self.code = code
+        self.constants = constants
+
+    def __reduce__(self):
+        return (Program.fromBytes, (self.toBytes(),))
+
+    def evaluate(self, variable_dict):
+        """Run the program, short-circuiting and/or chains. Uses constant
+        Python stack depth."""
+        code = self.code
+        constants = self.constants
+        stack = []
+        pc = 0
+        end = len(code)
+        while pc < end:
+            opcode = code[pc]
+            operand = code[pc + 1]
+            pc += 2
+            if opcode == Opcode.LOAD:
+                stack.append(variable_dict.get(constants[operand], False))
+            elif opcode == Opcode.LOAD_NOT:
+                stack.append(not variable_dict.get(constants[operand], False))
+            elif opcode == Opcode.PUSH:
+                stack.append(constants[operand])
+            elif opcode == Opcode.JUMP_IF_FALSE_OR_POP:
+                if stack[-1]:
+                    stack.pop()
+                else:
+                    pc = operand
+            elif opcode == Opcode.JUMP_IF_TRUE_OR_POP:
+                if stack[-1]:
+                    pc = operand
+                else:
+                    stack.pop()
+            else:
+                right = stack.pop()
+                stack[-1] = Opcode.OPERATIONS[opcode](stack[-1], right)
+        return stack[0]
+
+    def toBytes(self):
+        code = array(self.code.typecode, self.code)
+        if sys.byteorder != "little":
+            code.byteswap()
+
+        result = [self.MAGIC,
+                  self.code.typecode.encode("ascii"),
+                  struct.pack("<II", len(code), len(self.constants)),
+                  code.tobytes()]
+        for value in self.constants:
+            if type(value) is bool:
+                result.append(struct.pack("<c?", b"b", value))
+            elif type(value) is float:
+                result.append(struct.pack("<cd", b"f", value))
+            else:
+                encoded = value.encode("utf8")
+                result.append(struct.pack("<cI", b"s", len(encoded)))
+                result.append(encoded)
+        return b"".join(result)
+
+    @classmethod
+    def fromBytes(cls, data):
+        if data[:len(cls.MAGIC)] != cls.MAGIC:
+            raise Exception("Not a serialized Program")
+        offset = len(cls.MAGIC)
+        typecode = data[offset:offset + 1].decode("ascii")
+        offset += 1
+        codeLength, constantsCount = struct.unpack_from("<II", data, offset)
+        offset += 8
+
+        code = array(typecode)
+        size = codeLength * code.itemsize
+        code.frombytes(data[offset:offset + size])
+        if sys.byteorder != "little":
+            code.byteswap()
+        offset += size
+
+        constants = []
+        for _ in range(constantsCount):
+            kind = data[offset:offset + 1]
+            offset += 1
+            if kind == b"b":
+                constants.append(struct.unpack_from("<?", data, offset)[0])
+                offset += 1
+            elif kind == b"f":
+                constants.append(struct.unpack_from("<d", data, offset)[0])
+                offset += 8
+            elif kind == b"s":
+                length = struct.unpack_from("<I", data, offset)[0]
+                offset += 4
+                constants.append(data[offset:offset + length].decode("utf8"))
+                offset += length
+            else:
+                raise Exception("Unexpected constant kind " + repr(kind))
+
+        return cls(code, tuple(constants))
+
+
+class BDD:
+    """Reduced ordered binary decision diagram shared by many expressions.
+    Nodes are hash-consed, so identical sub-formulas of all the expressions
+    added to the same BDD end up being the same node. Node 0 is false, node
+    1 is true, any other node tests a variable and continues with its low
+    (false) or high (true) successor.
+
+    Only expressions combining variables, that is those accepted by
+    BooleanParser.compileMask, can be added."""
+
+    FALSE = 0
+    TRUE = 1
+
+    def __init__(self):
+        # Terminals test no variable and sort after all the variables
+        terminal = (float("inf"), None, None)
+        self.nodes = [terminal, terminal]
+        self.unique = {}
+        self.variables = {}
+        self.names = []
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def node(self, variable, low, high):
+        if low == high:
+            return low
+        key = (variable, low, high)
+        result = self.unique.get(key)
+        if result is None:
+            result = len(self.nodes)
+            self.nodes.append(key)
+            self.unique[key] = result
+        return result
+
+    def variable(self, name):
+        if name not in self.variables:
+            self.variables[name] = len(self.names)
+            self.names.append(name)
+        return self.node(self.variables[name], BDD.FALSE, BDD.TRUE)
+
+    def negate(self, u):
+        if u <= BDD.TRUE:
+            return BDD.TRUE - u
+        key = ("not", u)
+        if key not in self.operations:
+            variable, low, high = self.nodes[u]
+            self.operations[key] = self.node(variable, self.negate(low), self.negate(high))
+        return self.operations[key]
+
+    def apply(self, isAnd, u, v):
+        # Recursion depth is bounded by the number of variables
+        absorbing = BDD.FALSE if isAnd else BDD.TRUE
+        if u == absorbing or v == absorbing:
+            return absorbing
+        if u == BDD.TRUE - absorbing or u == v:
+            return v
+        if v == BDD.TRUE - absorbing:
+            return u
+
+        key = (isAnd, min(u, v), max(u, v))
+        if key not in self.operations:
+            uVariable, uLow, uHigh = self.nodes[u]
+            vVariable, vLow, vHigh = self.nodes[v]
+            variable = min(uVariable, vVariable)
+            if uVariable != variable:
+                uLow = uHigh = u
+            if vVariable != variable:
+                vLow = vHigh = v
+            self.operations[key] = self.node(variable,
+                                             self.apply(isAnd, uLow, vLow),
+                                             self.apply(isAnd, uHigh, vHigh))
+        return self.operations[key]
+
+    def add(self, parser):
+        """Add the expression of parser to the diagram, returns its root"""
+        with self.lock:
+            results = {}
+            pending = [(parser.root, False)]
+            while pending:
+                treeNode, ready = pending.pop()
+                tokenType = treeNode.tokenType
+                if tokenType in TokenType.LITERALS:
+                    results[treeNode] = BDD.TRUE if treeNode.value else BDD.FALSE
+                elif tokenType == TokenType.VAR:
+                    variable = treeNode.value
+                    if variable.startswith("!"):
+                        results[treeNode] = self.negate(self.variable(variable[1:]))
+                    else:
+                        results[treeNode] = self.variable(variable)
+                elif tokenType == TokenType.AND or tokenType == TokenType.OR:
+                    operands = parser.chainOperands(treeNode)
+                    if not ready:
+                        pending.append((treeNode, True))
+                        pending.extend((operand, False) for operand in operands)
+                        continue
+                    result = results.pop(operands[0])
+                    for operand in operands[1:]:
+                        result = self.apply(tokenType == TokenType.AND,
+                                            result,
+                                            results.pop(operand))
+                    results[treeNode] = result
+                else:
+                    raise Exception("Only expressions combining variables can be "
+                                    "added to a BDD: " + parser.expression)
+            return results[parser.root]
+
+    def evaluator(self, variable_dict):
+        """Return a function evaluating nodes of the diagram for the given
+        variable assignment, remembering the result of every node visited, so
+        that expressions sharing sub-formulas are evaluated once"""
+        nodes = self.nodes
+        names = self.names
+        memo = {BDD.FALSE: False, BDD.TRUE: True}
+
+        def evaluate(u):
+            path = []
+            while u not in memo:
+                path.append(u)
+                variable, low, high = nodes[u]
+                u = high if variable_dict.get(names[variable], False) else low
+            result = memo[u]
+            for visited in path:
+                memo[visited] = result
+            return result
+
+        return evaluate
+
+
+class ExpressionCache:
+    """Bounded LRU cache of BooleanParser instances, keyed by the expression
+    text with whitespace normalized. Safe to share between threads."""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(expression):
+        # Leave whitespace inside string literals alone
+        if '"' in expression or "'" in expression:
+            return expression.strip()
+        return " ".join(expression.split())
+
+    def get(self, expression):
+        key = self.normalize(expression)
+        with self.lock:
+            parser = self.entries.get(key)
+            if parser is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return parser
+
+        parser = BooleanParser(key)
+
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = parser
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return parser
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+expression_cache = ExpressionCache()
+
+
+def parse(expression):
+    return expression_cache.get(expression)
 
 
 if __name__ == "__main__":
@@ -252,3 +1094,134 @@ if __name__ == "__main__":
     single_quoted_p = BooleanParser("account_number == 'abc'")
     assert p.evaluate({'account_number': 'abc'}) == True
     assert p.evaluate({'account_number': "abc"}) == True
+
+    # The compiled function agrees with the flat program, also once reloaded
+    p = BooleanParser('(a and !b) or c == 2 or d .* "x"')
+    program = p.flatten()
+    reloaded = Program.fromBytes(program.toBytes())
+    assert reloaded.code == program.code and reloaded.constants == program.constants
+    for variables in ({'d': ''}, {'a': True, 'd': ''}, {'a': True, 'b': True, 'd': ''},
+                      {'c': 2, 'd': ''}, {'d': 'xyz'}):
+        assert p.evaluate(variables) == program.evaluate(variables)
+        assert p.evaluate(variables) == reloaded.evaluate(variables)
+
+    # Mask evaluation agrees with dictionary evaluation
+    bits = {'a': 1, 'b': 2, 'c': 4}
+    for expression in ('a', '!a', 'a and !b', 'a or b or !c', '(a or !b) and (c or !a)',
+                       'a and missing', 'a or !missing', '1 == 1', '!missing'):
+        p = BooleanParser(expression)
+        function = p.compileMask(bits)
+        for mask in range(8):
+            variables = {name: True for name, bit in bits.items() if mask & bit}
+            assert function(mask) == bool(p.evaluate(variables)), expression
+    assert BooleanParser('a == 1').compileMask(bits) is None
+
+    # Batch evaluation agrees with dictionary evaluation
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        matrix = numpy.array([[mask & bit != 0 for bit in bits.values()]
+                              for mask in range(8)])
+        columns = {name: index for index, name in enumerate(bits)}
+        for expression in ('a', '!a', 'a and !b', 'a or b or !c', '(a or !b) and (c or !a)',
+                           'a and missing', '!missing', '1 == 1', 'a == 1', 'b != 0'):
+            p = BooleanParser(expression)
+            expected = [bool(p.evaluate({name: True for name, bit in bits.items() if mask & bit}))
+                        for mask in range(8)]
+            assert list(p.evaluateBatch(matrix, columns)) == expected, expression
+
+    # Variables that must be true
+    assert BooleanParser("a and (b or c) and !d and e").requiredVariables() == ['a', 'e']
+    assert BooleanParser("a").requiredVariables() == ['a']
+    assert BooleanParser("a or b").requiredVariables() == []
+
+    # Tokenizer
+    t = Tokenizer("(x86-64 or !arm)and v!=-1.5e3 and s .* 'a b' or w>=.5")
+    t.tokenize()
+    assert list(t.tokens) == ['(', 'x86-64', 'or', '!arm', ')', 'and', 'v', '!=', '-1.5e3', 'and',
+                        's', '.*', "'a b'", 'or', 'w', '>=', '.5']
+    assert t.tokenTypes[1:4] == (TokenType.VAR, TokenType.OR, TokenType.VAR)
+    assert t.tokenTypes[8] == TokenType.NUM and t.tokenTypes[12] == TokenType.STR
+    assert t.offsets[:3] == (0, 1, 8)
+    t = Tokenizer("a = b")
+    t.tokenize()
+    assert list(t.tokens) == ['a', '=', 'b'] and t.tokenTypes[1] is None
+    for expression in ("linux windows", "a b", "a = b", "a => b", "(a", "a and", ")", "a)", ""):
+        try:
+            BooleanParser(expression)
+            assert False, expression
+        except AssertionError:
+            raise
+        except Exception as exception:
+            assert "expected" in str(exception), (expression, exception)
+    assert [isNumber(word) for word in ('1', '-2.', '1e', '.', 'e5', '3E+2')] == \
+        [True, True, False, False, False, True]
+
+    # Normalization
+    assert BooleanParser("1 == 1").isAlwaysTrue()
+    assert BooleanParser("a or 2 > 1").isAlwaysTrue()
+    assert BooleanParser("a and (b or 'x' == 'y') and 1 == 2").isAlwaysFalse()
+    assert BooleanParser("a and !a").isAlwaysFalse()
+    assert BooleanParser("!a or b or a").isAlwaysTrue()
+    assert not BooleanParser("a or b").isAlwaysTrue()
+    assert not BooleanParser("a or b").isAlwaysFalse()
+    p = BooleanParser("(a and (b and a)) and 1 == 1")
+    assert [child.value for child in p.root.children] == ['a', 'b']
+    p = BooleanParser("a or (a and b) or (c or a)")
+    assert [child.value for child in p.root.children] == ['a', 'c']
+    p = BooleanParser("b and (c or b)")
+    assert p.root.value == 'b'
+
+    # Parsers are immutable and can be shared between threads and processes
+    import pickle
+    from concurrent.futures import ThreadPoolExecutor
+    p = BooleanParser("(a or b) and !c")
+    try:
+        p.root = None
+        assert False
+    except AttributeError:
+        pass
+    assert pickle.loads(pickle.dumps(p)).evaluate({'a': True}) == True
+    assert pickle.loads(pickle.dumps(p.flatten())).evaluate({'b': True, 'c': True}) == False
+    with ThreadPoolExecutor(4) as pool:
+        parsers = list(pool.map(BooleanParser, ["a and !b"] * 8))
+        masks = list(pool.map(lambda parser: parser.compileMask(bits), parsers * 4))
+        assert all(mask(1) and not mask(3) for mask in masks)
+
+    # BDDs share sub-formulas and agree with dictionary evaluation
+    bdd = BDD()
+    expressions = ('a', '!a', 'a and !b', 'a or b or !c', '(a or !b) and (c or !a)',
+                   'a and missing', 'a or !missing', '1 == 1', '(!b and a) or 1 == 2')
+    roots = [bdd.add(BooleanParser(expression)) for expression in expressions]
+    assert roots[2] == roots[-1]
+    for mask in range(8):
+        variables = {name: True for name, bit in bits.items() if mask & bit}
+        evaluate = bdd.evaluator(variables)
+        for expression, root in zip(expressions, roots):
+            assert evaluate(root) == bool(BooleanParser(expression).evaluate(variables))
+
+    # Parsed expressions are shared through the cache
+    cache = ExpressionCache(size=2)
+    assert cache.get("a  and b") is cache.get(" a and b ")
+    cache.get("c")
+    cache.get("d")
+    assert (cache.hits, cache.misses, len(cache.entries)) == (1, 3, 2)
+    assert "a and b" not in cache.entries
+
+    # and/or short-circuit, d .* "x" would raise if evaluated
+    assert BooleanParser('a or d .* "x"').evaluate({'a': True}) == True
+    assert BooleanParser('!a and d .* "x"').evaluate({'a': True}) == False
+
+    # Long generated chains and deep nesting don't hit the recursion limit
+    chain = BooleanParser(" or ".join(f"arch{i}" for i in range(5000)))
+    assert chain.evaluate({'arch4999': True}) == True
+    assert chain.flatten().evaluate({}) == False
+    for depth in (110, 2000):
+        nested = BooleanParser("a and (b or (" * depth + "c" + "))" * depth)
+        assert nested.evaluate({'a': True, 'c': True}) == True
+        assert nested.evaluate({'c': True}) == False
+        assert nested.compileMask(bits) is None or nested.compileMask(bits)(5) == True
+    nested = BooleanParser("(" * 5000 + "a" + ")" * 5000)
+    assert nested.evaluate({'a': True}) == True
@@ -0,0 +1,373 @@
+#
+# This file is distributed under the MIT License. See LICENSE.md for details.
+#
+
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+from pathlib import Path
+
+script_directory = Path(__file__).resolve().parent
+default_configure = script_directory.parents[1] / "revng-test-configure"
+default_baselines = script_directory / "baselines.yml"
+
+# Each scenario generates:
+#
+# * `sources` source files, each one repeated for `architectures` architecture
+#   tags;
+# * a chain of `tag-depth` tags, each implying the previous one;
+# * `chain` command types, each one taking as input the previous one;
+# * `multi-input` command types taking one input from each of the first
+#   `arity` command types of the chain.
+scenarios = {
+    "small": {
+        "sources": 50,
+        "architectures": 4,
+        "tag-depth": 4,
+        "chain": 3,
+        "multi-input": 2,
+        "arity": 2,
+    },
+    "wide": {
+        "sources": 500,
+        "architectures": 8,
+        "tag-depth": 4,
+        "chain": 2,
+        "multi-input": 1,
+        "arity": 2,
+    },
+    "deep": {
+        "sources": 100,
+        "architectures": 4,
+        "tag-depth": 16,
+        "chain": 12,
+        "multi-input": 4,
+        "arity": 3,
+    },
+    # Large enough for anything quadratic in the number of targets to show
+    "large": {
+        "sources": 3000,
+        "architectures": 8,
+        "tag-depth": 4,
+        "chain": 3,
+        "multi-input": 1,
+        "arity": 2,
+    },
+}
+
+
+def accept_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark revng-test-configure on synthetic configurations"
+    )
+
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="SCENARIO",
+        help="Scenarios to run (default: all of them): " + ", ".join(scenarios),
+    )
+    parser.add_argument(
+        "--configure",
+        type=Path,
+        default=default_configure,
+        help="Path to the revng-test-configure script to benchmark",
+    )
+    parser.add_argument(
+        "--baselines",
+        type=Path,
+        default=default_baselines,
+        help="YAML file containing the reference results",
+    )
+    parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Number of runs of each scenario, the best one is considered",
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=1.5,
+        help="Fail if the time, relative to the calibration workload, exceeds "
+        "the baseline by this factor",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=1.25,
+        help="Fail if the peak RSS exceeds the baseline by this factor",
+    )
+    parser.add_argument(
+        "--update-baselines",
+        action="store_true",
+        help="Store the results as the new baselines instead of comparing them",
+    )
+    parser.add_argument(
+        "--keep",
+        type=Path,
+        help="Generate the scenarios in this directory and keep them",
+    )
+
+    # Internal: run a single measurement in the current process
+    parser.add_argument("--measure", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--calibrate", action="store_true", help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def generate_configuration(parameters):
+    architectures = [f"arch-{index}" for index in range(parameters["architectures"])]
+    levels = [f"level-{index}" for index in range(parameters["tag-depth"])]
+    chain = [f"step-{index + 1}" for index in range(parameters["chain"])]
+
+    tags = []
+    for index, architecture in enumerate(architectures):
+        tags.append(
+            {
+                "name": architecture,
+                "variables": {
+                    "TRIPLE": f"{architecture}-linux-",
+                    "CFLAGS": [f"-DARCH={index}"],
+                },
+            }
+        )
+    for index, level in enumerate(levels):
+        tag = {"name": level, "variables": {"CFLAGS": [f"-DLEVEL{index}"]}}
+        if index > 0:
+            tag["implies"] = [levels[index - 1]]
+        tags.append(tag)
+
+    sources = [
+        {
+            "tags": [levels[-1]],
+            "repeat-for": [[architecture] for architecture in architectures],
+            "members": [
+                f"tests/synthetic/source-{index}.c"
+                for index in range(parameters["sources"])
+            ],
+        }
+    ]
+
+    commands = []
+    for index, command_type in enumerate(chain):
+        if index == 0:
+            source = {"type": "source", "filter": levels[0]}
+        else:
+            source = {"type": chain[index - 1]}
+        commands.append(
+            {
+                "type": command_type,
+                "from": [source],
+                "command": "${TRIPLE}cc $CFLAGS $INPUT -o $OUTPUT",
+            }
+        )
+
+    arity = min(parameters["arity"], len(chain))
+    for index in range(parameters["multi-input"]):
+        # Leave out one architecture, if possible
+        excluded = architectures[index % len(architectures)]
+        included = [tag for tag in architectures if tag != excluded] or architectures
+        commands.append(
+            {
+                "type": f"combine-{index + 1}",
+                "from": [
+                    {"type": command_type, "filter": " or ".join(included)}
+                    for command_type in chain[:arity]
+                ],
+                "command": "cat "
+                + " ".join(f"$INPUT{input_index + 1}" for input_index in range(arity))
+                + " > $OUTPUT",
+            }
+        )
+
+    return {"tags": tags, "sources": sources, "commands": commands}
+
+
+def generate_scenario(directory, parameters):
+    install_path = directory / "install"
+    sources_path = install_path / "tests" / "synthetic"
+    sources_path.mkdir(parents=True)
+    for index in range(parameters["sources"]):
+        (sources_path / f"source-{index}.c").write_text("int main() { return 0; }\n")
+
+    with open(directory / "configuration.yml", "w") as configuration_file:
+        yaml.safe_dump(generate_configuration(parameters), configuration_file)
+
+
+def load_configure(path):
+    # revng-test-configure has no .py extension and imports boolparser from
+    # its own directory
+    sys.path.insert(0, str(path.parent))
+    loader = importlib.machinery.SourceFileLoader("revng_test_configure", str(path))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def calibrate():
+    """Run a fixed workload using the same kind of operations as configure
+    (dictionaries, sets, strings and sorting). Scenario times are measured in
+    units of its duration, so that baselines hold on faster or slower
+    machines."""
+    start = time.perf_counter()
+    groups = {}
+    for index in range(300000):
+        groups.setdefault(f"target-{index % 7919}", set()).add(index)
+    lines = [f"{name}: {' '.join(str(member) for member in sorted(members))}"
+             for name, members in sorted(groups.items())]
+    sum(len(line) for line in lines)
+    return {"time": time.perf_counter() - start}
+
+
+def measure(configure_path, directory):
+    configure = load_configure(configure_path)
+
+    # Each measurement writes to a new build directory, so that it always
+    # writes every file
+    build = Path(tempfile.mkdtemp(prefix="build-", dir=directory))
+
+    start = time.perf_counter()
+    with open(directory / "configuration.yml", "rb") as configuration_file:
+        data = yaml.load(configuration_file, Loader=configure.YAMLLoader)
+    config = configure.Configuration(data, set(), "1 == 1", directory / "install")
+    configure.emit_ninja(config, build)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"time": elapsed, "peak-rss": peak_rss, "targets": len(config.targets)}
+
+
+def run(arguments, options):
+    """Run benchmark.py with the given internal options in a new process as
+    many times as requested, return the results of each run"""
+    results = []
+    for _ in range(arguments.repetitions):
+        process = subprocess.run(
+            [sys.executable, __file__, "--configure", str(arguments.configure)]
+            + options,
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+        results.append(json.loads(process.stdout))
+    return results
+
+
+def run_calibration(arguments):
+    return min(result["time"] for result in run(arguments, ["--calibrate"]))
+
+
+def run_scenario(arguments, directory, calibration):
+    results = run(arguments, ["--measure", str(directory)])
+    elapsed = min(result["time"] for result in results)
+    return {
+        "time": round(elapsed, 4),
+        "relative-time": round(elapsed / calibration, 3),
+        "peak-rss": min(result["peak-rss"] for result in results),
+        "targets": results[0]["targets"],
+    }
+
+
+def check(name, result, baseline, arguments):
+    failures = []
+    if baseline is None:
+        return [f"{name}: no baseline"]
+
+    if result["targets"] != baseline["targets"]:
+        failures.append(
+            f"{name}: {result['targets']} targets instead of {baseline['targets']}"
+        )
+    if result["relative-time"] > baseline["relative-time"] * arguments.time_tolerance:
+        failures.append(
+            f"{name}: took {result['relative-time']:.3f} calibration units, "
+            f"baseline is {baseline['relative-time']:.3f}"
+        )
+    if result["peak-rss"] > baseline["peak-rss"] * arguments.memory_tolerance:
+        failures.append(
+            f"{name}: peak RSS is {result['peak-rss']} KiB, "
+            f"baseline is {baseline['peak-rss']} KiB"
+        )
+    return failures
+
+
+def main():
+    arguments = accept_arguments()
+    arguments.configure = arguments.configure.resolve()
+
+    if arguments.measure is not None:
+        json.dump(measure(arguments.configure, arguments.measure), sys.stdout)
+        return 0
+    elif arguments.calibrate:
+        json.dump(calibrate(), sys.stdout)
+        return 0
+
+    names = arguments.scenarios or list(scenarios)
+    for name in names:
+        if name not in scenarios:
+            sys.stderr.write(f"Unknown scenario: {name}\n")
+            return 1
+
+    baselines = {}
+    if arguments.baselines.exists():
+        with open(arguments.baselines) as baselines_file:
+            baselines = yaml.safe_load(baselines_file) or {}
+    baselines.setdefault("scenarios", {})
+
+    if arguments.keep is not None:
+        arguments.keep.mkdir(parents=True, exist_ok=True)
+        work_directory = Path(tempfile.mkdtemp(dir=arguments.keep))
+    else:
+        temporary_directory = tempfile.TemporaryDirectory()
+        work_directory = Path(temporary_directory.name)
+
+    calibration = run_calibration(arguments)
+    print(f"calibration: {calibration:.3f}s")
+
+    failures = []
+    for name in names:
+        directory = work_directory / name
+        generate_scenario(directory, scenarios[name])
+        result = run_scenario(arguments, directory, calibration)
+        print(
+            f"{name}: {result['targets']} targets, {result['time']:.3f}s "
+            f"({result['relative-time']:.3f} calibration units), "
+            f"{result['peak-rss']} KiB peak RSS"
+        )
+
+        if arguments.update_baselines:
+            baselines["scenarios"][name] = result
+        else:
+            failures += check(name, result, baselines["scenarios"].get(name), arguments)
+
+    if arguments.update_baselines:
+        baselines = {
+            "calibration": round(calibration, 4),
+            "scenarios": baselines["scenarios"],
+        }
+
+    if arguments.update_baselines:
+        with open(arguments.baselines, "w") as baselines_file:
+            baselines_file.write(
+                "# Reference results of benchmark.py, regenerate with "
+                "--update-baselines\n"
+            )
+            yaml.safe_dump(baselines, baselines_file)
+
+    for failure in failures:
+        sys.stderr.write(f"Regression: {failure}\n")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())